@@ -1,11 +1,19 @@
 from datetime import datetime
 from string import Template
+from email import policy
+from email.generator import BytesGenerator
+from email.headerregistry import Address
 from email.message import EmailMessage
-from email.utils import formataddr, formatdate, make_msgid
-from typing import Optional
+from email.utils import formataddr, formatdate
+from typing import Callable, NamedTuple, Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache, partial
 from email_validator import validate_email, EmailNotValidError
 from dotenv import load_dotenv
+from io import BytesIO
+from logging.handlers import QueueHandler, QueueListener
 import smtplib, socket, csv, mimetypes, os, random, time, ssl, logging, re
+import atexit, itertools, queue, threading
 
 FALLBACKS = {
     "name": "there",
@@ -30,31 +38,105 @@ ATTACHMENT_PATH = os.getenv("ATTACHMENT_PATH", "").strip() or None
 
 RATE_LIMIT_PER_MIN = max(1, int(os.getenv("RATE_LIMIT_PER_MIN", "60")))
 MAX_RETRIES = max(1, int(os.getenv("MAX_RETRIES", "3")))
+CONCURRENCY = max(1, int(os.getenv("CONCURRENCY", "4")))
+# providers cap messages per SMTP session; reconnect before hitting it
+MAX_MSGS_PER_CONN = max(1, int(os.getenv("MAX_MSGS_PER_CONN", "1000")))
+DNS_CONCURRENCY = max(1, int(os.getenv("DNS_CONCURRENCY", "32")))
+# abort the run once at least FAIL_MIN_BATCH sends were attempted and
+# FAIL_RATIO of them failed (revoked creds, blacklisted IP, ...)
+FAIL_MIN_BATCH = max(1, int(os.getenv("FAIL_MIN_BATCH", "30")))
+FAIL_RATIO = float(os.getenv("FAIL_RATIO", str(1 / 3)))
+if not 0 < FAIL_RATIO <= 1:
+    FAIL_RATIO = min(1.0, FAIL_RATIO) if FAIL_RATIO > 0 else 1 / 3
 
 RECIPIENTS_CSV = "recipients.csv"
 HTML_TMPL_PATH = "email_template.html"
 TEXT_TMPL_PATH = "email_template.txt"
 
 DRY_RUN = os.getenv("DRY_RUN", "true").lower() == "true"
+# serialize the MIME body once and only substitute ${...} in the bytes
+FAST_SERIALIZE = os.getenv("FAST_SERIALIZE", "false").lower() == "true"
+# RFC 5322 2.1.1: hard limit for a line of an 8bit body, excluding CRLF
+MAX_LINE_OCTETS = 998
 SUPPRESSIONS_FILE = os.getenv("SUPPRESSIONS_FILE", "suppressions.txt")
 JITTER = 0.2
 
 UNSUBSCRIBE_MAILTO = os.getenv("UNSUBSCRIBE_MAILTO", "")
 UNSUBSCRIBE_URL = os.getenv("UNSUBSCRIBE_URL", "")
 
+_FROM_HEADER = formataddr((FROM_NAME, FROM_EMAIL))
+_date_cache = (0, "")
 
-# Logging
+# Message-ID parts fixed per run; unlike make_msgid() no getfqdn()/clock per call
+_MSGID_DOMAIN = FROM_EMAIL.split("@", 1)[1] if "@" in FROM_EMAIL else "localhost"
+_MSGID_BASE = f"{int(time.time())}.{os.getpid()}.{os.urandom(4).hex()}"
+_MSGID_COUNTER = itertools.count()
+
+
+class _ResumingSSLContext(ssl.SSLContext):
+    """
+    Offers the last TLS session to every new connection, so reconnects
+    to SMTP_HOST can resume instead of doing a full handshake.
+    """
+
+    last_session = None
+
+    def wrap_socket(self, sock, *args, session=None, **kwargs):
+        return super().wrap_socket(
+            sock, *args, session=session or self.last_session, **kwargs
+        )
+
+
+def _make_ssl_context() -> ssl.SSLContext:
+    # copy whatever ssl.create_default_context() sets on this Python
+    # (e.g. VERIFY_X509_STRICT on 3.13+, SSLKEYLOGFILE), built once per run
+    default = ssl.create_default_context()
+    ctx = _ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ctx.options = default.options
+    ctx.minimum_version = default.minimum_version
+    ctx.maximum_version = default.maximum_version
+    ctx.verify_mode = default.verify_mode
+    ctx.verify_flags = default.verify_flags
+    ctx.check_hostname = default.check_hostname
+    if getattr(default, "keylog_filename", None):
+        ctx.keylog_filename = default.keylog_filename
+    ctx.load_default_certs(ssl.Purpose.SERVER_AUTH)
+    return ctx
+
+
+_SSL_CTX = _make_ssl_context()
+
+_PLACEHOLDER_RE = re.compile(r"\$\{([a-zA-Z_]\w*)\}")
+_PLACEHOLDER_BYTES_RE = re.compile(rb"\$\{([a-zA-Z_]\w*)\}")
+
+
+class Attachment(NamedTuple):
+    data: bytes
+    maintype: str
+    subtype: str
+    filename: str
+
+
+_ATTACHMENT: Optional[Attachment] = None
+
+
+# Logging: workers only enqueue records, a background listener writes them
 os.makedirs("logs", exist_ok=True)
 log_name = datetime.now().strftime("logs/send_%Y%m%d_%H%M%S.log")
-logging.basicConfig(
-    filename=log_name,
-    level=logging.INFO,
-    format="%(asctime)s | %(levelname)s | %(message)s",
+file_handler = logging.FileHandler(log_name, encoding="utf-8")
+file_handler.setFormatter(
+    logging.Formatter("%(asctime)s | %(levelname)s | %(message)s")
 )
 console = logging.StreamHandler()
 console.setLevel(logging.INFO)
 console.setFormatter(logging.Formatter("%(levelname)s | %(message)s"))
-logging.getLogger().addHandler(console)
+
+log_queue = queue.Queue(-1)
+log_listener = QueueListener(
+    log_queue, file_handler, console, respect_handler_level=True
+)
+logging.getLogger().addHandler(QueueHandler(log_queue))
+logging.getLogger().setLevel(logging.INFO)
 
 
 # ---------- Helpers ----------
@@ -63,24 +145,81 @@ def read_template(path: str) -> Template:
         return Template(f.read())
 
 
+Renderer = Callable[[dict], str]
+
+
+def compile_template(tmpl: Template | str) -> Renderer:
+    """
+    Parses a template once into literal chunks and placeholder slots and
+    returns a renderer equivalent to Template.safe_substitute(row).
+    """
+    if not isinstance(tmpl, Template):
+        tmpl = Template(tmpl)
+    src = tmpl.template
+    parts = []  # str = literal, tuple = (key, text to keep if key is missing)
+    last = 0
+    for m in tmpl.pattern.finditer(src):
+        parts.append(src[last : m.start()])
+        key = m.group("named") or m.group("braced")
+        if key is not None:
+            parts.append((key, m.group()))
+        elif m.group("escaped") is not None:
+            parts.append(tmpl.delimiter)
+        else:  # invalid: safe_substitute keeps it as-is
+            parts.append(m.group())
+        last = m.end()
+    parts.append(src[last:])
+    parts = [p for p in parts if p != ""]
+
+    def render(row: dict) -> str:
+        return "".join(
+            p if isinstance(p, str) else str(row.get(p[0], p[1])) for p in parts
+        )
+
+    return render
+
+
+_UNSUB_URL_TMPL = compile_template(UNSUBSCRIBE_URL) if UNSUBSCRIBE_URL else None
+
+
+def is_static(tmpl: Template) -> bool:
+    """
+    True if the template has no placeholders, i.e. renders the same for every row.
+    """
+    return not any(
+        m.group("named") or m.group("braced")
+        for m in tmpl.pattern.finditer(tmpl.template)
+    )
+
+
+def fits_8bit(*tmpls: Template) -> bool:
+    """
+    True if every template line fits the MAX_LINE_OCTETS limit of 8bit bodies.
+    """
+    return all(
+        len(line.encode("utf-8")) <= MAX_LINE_OCTETS
+        for t in tmpls
+        for line in t.template.splitlines()
+    )
+
+
 def extract_placeholders(*tmpls: Template) -> set[str]:
-    pat = re.compile(r"\$\{([a-zA-Z_]\w*)\}")
     keys = set()
     for t in tmpls:
         s = t.template if isinstance(t, Template) else str(t)
-        keys.update(pat.findall(s))
+        keys.update(_PLACEHOLDER_RE.findall(s))
     return keys
 
 
 def ensure_required_fields(
-    row: dict, used_keys: set[str], i: int, total: int
+    row: dict, required_extra: set[str], i: int, total: int
 ) -> tuple[bool, str]:
     """
-    Връща (ok, reason). Валидира само полетата, които реално се ползват в шаблоните.
+    Връща (ok, reason). Валидира само полетата, които реално се ползват в шаблоните
+    (required_extra = used_keys & {"name", "company"}, изчислено веднъж в main).
     """
-    # винаги изискваме email (ще го нормализираме отделно)
-    required = {"email"} | (used_keys & {"name", "company"})
-    for key in required - {"email"}:
+    # email се нормализира отделно
+    for key in required_extra:
         val = (row.get(key) or "").strip()
         if not val:
             fb = FALLBACKS.get(key, None)
@@ -93,41 +232,125 @@ def ensure_required_fields(
 
 def load_recipients(csv_path: str):
     with open(csv_path, newline="", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
+        reader = csv.reader(f)
+        headers = [h.strip().lower() for h in next(reader, [])]
         for row in reader:
-            out = {}
-            for k, v in row.items():
-                if k is None:
-                    continue
-                key = k.strip().lower()
-                out[key] = (v or "").strip()
+            # short rows get "" for missing columns, like DictReader's restval
+            out = dict.fromkeys(headers, "")
+            out.update(zip(headers, (c.strip() for c in row)))
             if not any(out.values()):
                 continue
             yield out
 
 
-def attach_file(msg: EmailMessage, file_path: str):
+def count_rows(csv_path: str) -> int:
+    """
+    Fast row count for progress output: lines with any non-separator
+    content, minus the header. (A quoted multi-line field counts twice.)
+    """
+    with open(csv_path, "rb") as f:
+        return max(0, sum(1 for line in f if line.strip(b" \t\r\n,")) - 1)
+
+
+def _mime_for(file_path: str) -> tuple[str, str, str]:
     ctype, encoding = mimetypes.guess_type(file_path)
     if ctype is None or encoding is not None:
         ctype = "application/octet-stream"
     maintype, subtype = ctype.split("/", 1)
+    return maintype, subtype, os.path.basename(file_path)
+
 
+def _preload_attachment(file_path: str) -> Attachment:
+    """
+    Reads the attachment and resolves its MIME type once for the whole run.
+    """
+    maintype, subtype, filename = _mime_for(file_path)
     with open(file_path, "rb") as f:
         data = f.read()
-    filename = os.path.basename(file_path)
-    msg.add_attachment(data, maintype=maintype, subtype=subtype, filename=filename)
+    return Attachment(data, maintype, subtype, filename)
 
 
-def normalize_email(addr: str) -> str | None:
+def attach_file(msg: EmailMessage, preloaded: Attachment):
+    msg.add_attachment(
+        preloaded.data,
+        maintype=preloaded.maintype,
+        subtype=preloaded.subtype,
+        filename=preloaded.filename,
+    )
+
+
+@lru_cache(maxsize=100_000)
+def _validate_syntax(addr: str) -> tuple[Optional[str], Optional[str], str]:
     """
-    Return normalize email or None, if unvalid.
+    Returns (normalized, domain, error). Invalid addresses are cached too.
+    """
+    try:
+        v = validate_email(addr, check_deliverability=False)
+        return v.normalized, v.domain, ""
+    except EmailNotValidError as e:
+        return None, None, str(e)
+
+
+def _check_mx(domain: str) -> str:
+    """
+    Deliverability (MX/DNS) check for one domain. Returns "" if ok.
     """
     try:
-        v = validate_email(addr, check_deliverability=True)
-        return v.normalized
+        validate_email(f"postmaster@{domain}", check_deliverability=True)
+        return ""
     except EmailNotValidError as e:
-        logging.warning(f"Invalid email '{addr}': {e}")
+        return str(e)
+
+
+# one lookup per domain, shared by prefetch_mx and normalize_email
+_dns_pool = ThreadPoolExecutor(max_workers=DNS_CONCURRENCY, thread_name_prefix="dns")
+_mx_futures: dict[str, Future] = {}
+_mx_lock = threading.Lock()
+
+
+def mx_future(domain: str) -> Future:
+    with _mx_lock:
+        fut = _mx_futures.get(domain)
+        if fut is None:
+            fut = _mx_futures[domain] = _dns_pool.submit(_check_mx, domain)
+    return fut
+
+
+def prefetch_mx(addresses, stop: threading.Event):
+    """
+    Background thread next to the producer: starts the deliverability
+    lookup for each recipient domain as soon as its row is read, so the
+    producer usually finds the answer ready without waiting on the
+    whole list first.
+    """
+    try:
+        for addr in addresses:
+            if stop.is_set():
+                break
+            local, at, domain = addr.rpartition("@")
+            # same key as the validated domain for plain ASCII domains; anything
+            # else (IDN, odd syntax) is left to normalize_email
+            domain = domain.lower()
+            if local and at and domain.isascii() and "." in domain:
+                mx_future(domain)
+    except Exception:
+        # unreadable CSV, or the DNS pool already shut down at the end of the
+        # run; the producer looks up whatever is left (and reports bad input)
+        if not stop.is_set():
+            logging.exception("MX prefetch stopped early.")
+
+
+def normalize_email(addr: str) -> str | None:
+    """
+    Return normalize email or None, if unvalid.
+    """
+    normalized, domain, err = _validate_syntax(addr)
+    if normalized and domain:
+        err = mx_future(domain).result()
+    if err:
+        logging.warning(f"Invalid email '{addr}': {err}")
         return None
+    return normalized
 
 
 def csv_preflight(csv_path: str, required=("email",)) -> bool:
@@ -192,11 +415,11 @@ def smtp_config_preflight() -> bool:
             f"Unsupported SMTP_SECURE='{SMTP_SECURE}' (use starttls|ssl|none)"
         )
 
-    # 4) Validate FROM/REPLY-TO emails
+    # 4) Validate FROM/REPLY-TO emails (syntax only: their MX is not used for sending)
     from_norm = None
     if FROM_EMAIL:
         try:
-            v = validate_email(FROM_EMAIL, check_deliverability=True)
+            v = validate_email(FROM_EMAIL, check_deliverability=False)
             from_norm = v.normalized
         except EmailNotValidError as e:
             errors.append(f"Invalid FROM_EMAIL '{FROM_EMAIL}': {e}")
@@ -208,7 +431,7 @@ def smtp_config_preflight() -> bool:
     reply_to_norm = None
     if REPLY_TO:
         try:
-            v = validate_email(REPLY_TO, check_deliverability=True)
+            v = validate_email(REPLY_TO, check_deliverability=False)
             reply_to_norm = v.normalized
         except EmailNotValidError as e:
             errors.append(f"Invalid REPLY_TO '{REPLY_TO}': {e}")
@@ -225,13 +448,12 @@ def smtp_config_preflight() -> bool:
     # 6) Quick connectivity/TLS check (no login)
     try:
         if secure == "ssl":
-            ctx = ssl.create_default_context()
-            with smtplib.SMTP_SSL(SMTP_HOST, port, context=ctx, timeout=15) as s:
+            with smtplib.SMTP_SSL(SMTP_HOST, port, context=_SSL_CTX, timeout=15) as s:
                 s.ehlo()
         elif secure == "starttls":
             with smtplib.SMTP(SMTP_HOST, port, timeout=15) as s:
                 s.ehlo()
-                s.starttls(context=ssl.create_default_context())
+                s.starttls(context=_SSL_CTX)
                 s.ehlo()
         else:  # none
             with socket.create_connection((SMTP_HOST, port), timeout=10):
@@ -267,54 +489,157 @@ def smtp_config_preflight() -> bool:
     return True
 
 
-def build_message(
-    row: dict, subject_tmpl: Template, html_tmpl: Template, text_tmpl: Template
-):
-    substitutions = {k: v for k, v in row.items()}  # email,name,company,...
+def new_msgid() -> str:
+    return f"<{_MSGID_BASE}.{next(_MSGID_COUNTER)}@{_MSGID_DOMAIN}>"
 
-    msg = EmailMessage()
-    msg["Subject"] = subject_tmpl.safe_substitute(substitutions)
-    msg["From"] = formataddr((FROM_NAME, FROM_EMAIL))
-    msg["Reply-To"] = REPLY_TO
-    msg["Message-ID"] = make_msgid()
-    msg["Date"] = formatdate(localtime=True)
-    msg["To"] = formataddr((row.get("name", ""), row["email"]))
 
+def date_header() -> str:
+    """
+    Date header value, re-formatted at most once per second.
+    """
+    global _date_cache
+    now = int(time.time())
+    t, value = _date_cache
+    if t != now:
+        value = formatdate(now, localtime=True)
+        _date_cache = (now, value)
+    return value
+
+
+def list_unsubscribe(row: dict) -> str:
     lh = []
     if UNSUBSCRIBE_MAILTO:
         lh.append(f"<mailto:{UNSUBSCRIBE_MAILTO}>")
-    if UNSUBSCRIBE_URL:
-        lh.append(f"<{Template(UNSUBSCRIBE_URL).safe_substitute(substitutions)}>")
-    if lh:
-        msg["List-Unsubscribe"] = ", ".join(lh)
+    if _UNSUB_URL_TMPL:
+        lh.append(f"<{_UNSUB_URL_TMPL(row)}>")
+    return ", ".join(lh)
+
+
+def build_message(
+    row: dict,
+    subject_tmpl: Renderer,
+    html_tmpl: Renderer,
+    text_tmpl: Renderer,
+    attachment: Optional[Attachment] = None,
+    msg_policy=policy.default,
+):
+    msg = EmailMessage(policy=msg_policy)
+    msg["Subject"] = subject_tmpl(row)
+    msg["From"] = _FROM_HEADER
+    msg["Reply-To"] = REPLY_TO
+    msg["Message-ID"] = new_msgid()
+    msg["Date"] = date_header()
+    msg["To"] = Address(row.get("name", ""), addr_spec=row["email"])
+
+    unsub = list_unsubscribe(row)
+    if unsub:
+        msg["List-Unsubscribe"] = unsub
         msg["List-Unsubscribe-Post"] = "List-Unsubscribe=One-Click"
 
-    text_body = text_tmpl.safe_substitute(substitutions)
-    html_body = html_tmpl.safe_substitute(substitutions)
+    text_body = text_tmpl(row)
+    html_body = html_tmpl(row)
 
     # alternative parts: text + html
     msg.set_content(text_body)
     msg.add_alternative(html_body, subtype="html")
 
-    if ATTACHMENT_PATH:
-        try:
-            attach_file(msg, ATTACHMENT_PATH)
-        except Exception as e:
-            logging.error(f"Attachment error for {row['email']}: {e}")
+    if attachment:
+        attach_file(msg, attachment)
 
     return msg
 
 
+_SMTP_UTF8 = policy.SMTP.clone(utf8=True)
+# bodies come out quoted-printable/base64, never 8bit: safe without 8BITMIME
+_SEVEN_BIT = policy.default.clone(cte_type="7bit")
+
+
+def _flatten(msg: EmailMessage, pol=policy.SMTP) -> bytes:
+    buf = BytesIO()
+    BytesGenerator(buf, mangle_from_=False, policy=pol).flatten(msg)
+    return buf.getvalue()
+
+
+def build_base_bytes(
+    text_body: str,
+    html_body: str,
+    attachment: Optional[Attachment] = None,
+    cte: Optional[str] = None,
+) -> tuple[bytes, bytes]:
+    """
+    Serializes everything shared by all recipients once: constant headers,
+    text/html parts and the attachment. Returns (prefix, tail): prefix holds
+    the headers and text/html parts, tail the attachment part, which never
+    needs substitution. Per-recipient headers are spliced in front by
+    render_fast().
+    """
+    msg = EmailMessage()
+    msg["From"] = _FROM_HEADER
+    msg["Reply-To"] = REPLY_TO
+    if UNSUBSCRIBE_MAILTO or _UNSUB_URL_TMPL:
+        msg["List-Unsubscribe-Post"] = "List-Unsubscribe=One-Click"
+
+    msg.set_content(text_body, cte=cte)
+    msg.add_alternative(html_body, subtype="html", cte=cte)
+
+    if attachment:
+        attach_file(msg, attachment)
+
+    data = _flatten(msg)
+    if not attachment:
+        return data, b""
+    # split right after the closing boundary of the text/html alternative
+    alt_end = b"--" + msg.get_payload(0).get_boundary().encode("ascii") + b"--"
+    split = data.index(alt_end) + len(alt_end)
+    return data[:split], data[split:]
+
+
+def render_fast(
+    row: dict,
+    base: tuple[bytes, bytes],
+    subject_tmpl: Renderer,
+    personalize: bool,
+    fallback=None,
+):
+    hdr = EmailMessage()
+    hdr["Subject"] = subject_tmpl(row)
+    hdr["Message-ID"] = new_msgid()
+    hdr["Date"] = date_header()
+    hdr["To"] = Address(row.get("name", ""), addr_spec=row["email"])
+    unsub = list_unsubscribe(row)
+    if unsub:
+        hdr["List-Unsubscribe"] = unsub
+    # header-only message flattens to "<headers>\r\n"; drop the blank line.
+    # IDN recipients need raw UTF-8 headers (sent with SMTPUTF8)
+    head = _flatten(hdr, policy.SMTP if row["email"].isascii() else _SMTP_UTF8)[:-2]
+
+    prefix, tail = base
+    if personalize:
+        # single pass, so a value containing ${other} is not substituted again
+        prefix = _PLACEHOLDER_BYTES_RE.sub(
+            lambda m: (
+                row[key].encode("utf-8")
+                if (key := m.group(1).decode("ascii")) in row
+                else m.group()
+            ),
+            prefix,
+        )
+        # long substituted values can push a line past the 8bit limit;
+        # such rows go through the regular EmailMessage path (QP/base64)
+        if fallback and max(map(len, prefix.split(b"\r\n"))) > MAX_LINE_OCTETS:
+            return fallback(row)
+    return head + prefix + tail
+
+
 def smtp_client():
-    ctx = ssl.create_default_context()
     if SMTP_SECURE == "ssl":
-        server = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=ctx, timeout=30)
+        server = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=_SSL_CTX, timeout=30)
         server.ehlo()
     else:
         server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30)
         server.ehlo()
         if SMTP_SECURE == "starttls":
-            server.starttls(context=ctx)
+            server.starttls(context=_SSL_CTX)
             server.ehlo()
         elif SMTP_SECURE == "none":
             pass
@@ -322,10 +647,95 @@ def smtp_client():
             raise RuntimeError(
                 f"Unsupported SMTP_SECURE='{SMTP_SECURE}' (use starttls|ssl|none)"
             )
+    if isinstance(server.sock, ssl.SSLSocket):
+        # read after EHLO, so TLS 1.3 session tickets have arrived
+        _SSL_CTX.last_session = server.sock.session
     server.login(SMTP_USER, SMTP_PASS)
     return server
 
 
+# ---------- Rate limiting ----------
+class TokenBucket:
+    """
+    Thread-safe token bucket shared by all workers: allows bursts up to
+    `capacity`, refills at `rate` tokens per second.
+    """
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = float(capacity)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, cancel: Optional[threading.Event] = None):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.last_refill) * self.rate
+            )
+            self.last_refill = now
+            self.tokens -= 1
+            # negative balance = reserved token, wait until it is refilled
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            if cancel is not None:
+                cancel.wait(wait)  # wakes early when the run is stopped
+            else:
+                time.sleep(wait)
+
+
+bucket = TokenBucket(RATE_LIMIT_PER_MIN, RATE_LIMIT_PER_MIN / 60.0)
+
+
+# ---------- Worker state ----------
+_worker_local = threading.local()
+_smtp_sessions = set()
+_smtp_sessions_lock = threading.Lock()
+
+
+def _init_worker():
+    # one persistent session per worker, opened lazily on first send
+    _worker_local.smtp = None
+    # private RNG per worker: no contention on the global random lock
+    _worker_local.rng = random.Random(os.urandom(8))
+
+
+def _worker_smtp(reconnect: bool = False):
+    smtp = getattr(_worker_local, "smtp", None)
+    if smtp is not None and not reconnect:
+        if _worker_local.msgs_on_conn < MAX_MSGS_PER_CONN:
+            return smtp
+        logging.info(
+            f"Rotating SMTP connection after {_worker_local.msgs_on_conn} messages."
+        )
+    if smtp is not None:
+        _quit_smtp(smtp)
+    smtp = smtp_client()
+    _worker_local.smtp = smtp
+    _worker_local.msgs_on_conn = 0
+    with _smtp_sessions_lock:
+        _smtp_sessions.add(smtp)
+    return smtp
+
+
+def _quit_smtp(smtp):
+    with _smtp_sessions_lock:
+        _smtp_sessions.discard(smtp)
+    try:
+        smtp.quit()
+    except Exception:
+        pass
+
+
+@atexit.register
+def close_smtp_sessions():
+    with _smtp_sessions_lock:
+        sessions = list(_smtp_sessions)
+    for smtp in sessions:
+        _quit_smtp(smtp)
+
+
 def require_file(path: str, label: str) -> bool:
     if not os.path.exists(path):
         logging.error(f"{label} '{path}' not found. Aborting.")
@@ -333,8 +743,200 @@ def require_file(path: str, label: str) -> bool:
     return True
 
 
+def prepare_row(
+    row: dict,
+    i: int,
+    total: int,
+    render,
+    required_extra: set[str],
+    suppressions: frozenset[str],
+):
+    """
+    Validates one row and builds its message (producer side).
+    Returns (status, msg): msg is None and status is one of
+    skipped | invalid | failed when the row will not be sent.
+    """
+    email = (row.get("email") or "").strip()
+    # cheap suppression check first, so suppressed rows never hit DNS
+    if email.lower() in suppressions:
+        logging.info(f"[{i}/{total}] Suppressed: {email}. Skipping.")
+        return "skipped", None
+
+    normalized = normalize_email(email)
+    if not normalized:
+        logging.warning(f"[{i}/{total}] Invalid email: {email}. Skipping.")
+        return "invalid", None
+
+    row["email"] = normalized
+
+    # canonical form may still match (e.g. IDN domain in suppressions)
+    if normalized.lower() in suppressions:
+        logging.info(f"[{i}/{total}] Suppressed: {email}. Skipping.")
+        return "skipped", None
+
+    if required_extra:
+        ok, reason = ensure_required_fields(row, required_extra, i, total)
+        if not ok:
+            logging.warning(reason)
+            return "failed", None
+
+    return "", render(row)
+
+
+def _raw_mail_options(smtp, msg: bytes, email: str) -> Optional[list[str]]:
+    """
+    MAIL options for sending prebuilt bytes with sendmail(), or None if
+    this server can't take them as-is and the EmailMessage path is needed.
+    """
+    if not email.isascii():
+        # same as send_message(): international address needs SMTPUTF8
+        if smtp.has_extn("smtputf8"):
+            return ["SMTPUTF8", "BODY=8BITMIME"]
+        return None
+    if msg.isascii():
+        return []
+    if smtp.has_extn("8bitmime"):
+        return ["BODY=8BITMIME"]
+    return None
+
+
+def deliver(msg, row: dict, i: int, total: int, fallback, stop=None) -> str:
+    """
+    Sends one prepared message on the worker's SMTP session (consumer side).
+    `fallback` rebuilds the row as an EmailMessage when prebuilt bytes
+    can't be sent as-is. Returns one of: sent | skipped (dry-run) | error |
+    cancelled (run stopped while waiting for the rate limiter).
+    """
+    email = row["email"]
+    status = "error"
+    reconnect = False
+    # retry with backoff
+    for attempt in range(1, MAX_RETRIES + 1):
+        try:
+            if DRY_RUN:
+                logging.info(f"[{i}/{total}] DRY-RUN to {email} (skipped sending)")
+                status = "skipped"
+                break
+
+            smtp = _worker_smtp(reconnect)
+            reconnect = False
+            bucket.acquire(stop)
+            if stop is not None and stop.is_set():
+                return "cancelled"
+            _worker_local.msgs_on_conn += 1
+            mail_options = None
+            if isinstance(msg, bytes):
+                mail_options = _raw_mail_options(smtp, msg, email)
+            if mail_options is not None:
+                smtp.sendmail(FROM_EMAIL, [email], msg, mail_options)
+            else:
+                if isinstance(msg, bytes):
+                    msg = fallback(row)  # from now on retry the rebuilt message
+                smtp.send_message(msg)
+            status = "sent"
+            logging.info(f"[{i}/{total}] Sent to {email}")
+            break
+
+        except smtplib.SMTPServerDisconnected as e:
+            logging.warning(
+                f"[{i}/{total}] SMTP disconnected for {email}: {e}. Reconnecting…"
+            )
+            try:
+                _worker_smtp(reconnect=True)
+                continue
+            except Exception as e2:
+                logging.error(f"Reconnect failed: {e2}")
+                reconnect = True
+                is_temp = True
+
+        except smtplib.SMTPNotSupportedError as e:
+            # e.g. IDN recipient on a server without SMTPUTF8: retrying won't help
+            logging.error(f"[{i}/{total}] Not supported by server for {email}: {e}")
+            is_temp = False
+
+        except smtplib.SMTPResponseException as e:
+            code = e.smtp_code
+            err = (
+                e.smtp_error.decode()
+                if isinstance(e.smtp_error, bytes)
+                else str(e.smtp_error)
+            )
+            logging.error(f"[{i}/{total}] SMTP {code} to {email}: {err}")
+            is_temp = 400 <= code < 500
+
+        except Exception as e:
+            logging.error(f"[{i}/{total}] Error to {email}: {e}")
+            is_temp = True
+
+        if attempt < MAX_RETRIES and is_temp:
+            jitter = _worker_local.rng.random() * JITTER
+            sleep_time = min(60, (2 ** (attempt - 1)) + jitter)
+            time.sleep(sleep_time)
+        else:
+            break
+
+    return status
+
+
+def _produce(
+    rows, total, render, required_extra, suppressions, outbox, results, stop
+):
+    """
+    Producer thread: validates and renders rows ahead of the senders, so
+    DNS/template work overlaps with SMTP round-trips.
+    """
+    i = 0
+    try:
+        for i, row in enumerate(rows, start=1):
+            if stop.is_set():
+                break
+            try:
+                status, msg = prepare_row(
+                    row, i, total, render, required_extra, suppressions
+                )
+            except Exception:
+                # one bad row (e.g. newline in a header field) must not end the run
+                logging.exception(f"[{i}/{total}] Could not build message. Skipping.")
+                results.put("failed")
+                continue
+            if msg is None:
+                results.put(status)
+            else:
+                outbox.put((msg, row, i))
+    except Exception:
+        # the CSV itself can't be read on (bad encoding, csv.Error): messages
+        # already queued still go out, the rest of the list is not reached
+        logging.exception(f"Could not read recipients after row {i}. Stopping.")
+        results.put("aborted")
+    finally:
+        for _ in range(CONCURRENCY):
+            outbox.put(None)
+        results.put(None)
+
+
+def _consume(total, fallback, outbox, results, stop):
+    try:
+        while (item := outbox.get()) is not None:
+            if stop.is_set():
+                continue  # aborting: drain the queue without sending
+            msg, row, i = item
+            results.put(deliver(msg, row, i, total, fallback, stop))
+    finally:
+        results.put(None)
+
+
 # ---------- Main ----------
 def main():
+    log_listener.start()
+    try:
+        run()
+    finally:
+        log_listener.stop()
+
+
+def run():
+    global _ATTACHMENT
+
     if not all([SMTP_HOST, SMTP_PORT, SMTP_USER, SMTP_PASS, FROM_EMAIL]):
         logging.error("Missing SMTP config. Check config.env")
         return
@@ -345,26 +947,76 @@ def main():
     ):
         return
 
+    if ATTACHMENT_PATH:
+        try:
+            _ATTACHMENT = _preload_attachment(ATTACHMENT_PATH)
+        except Exception as e:
+            logging.error(f"Attachment error for '{ATTACHMENT_PATH}': {e}. Aborting.")
+            return
+
     subject_tmpl = Template(SUBJECT_TMPL)
     html_tmpl = read_template(HTML_TMPL_PATH)
     text_tmpl = read_template(TEXT_TMPL_PATH)
 
     used_keys = extract_placeholders(subject_tmpl, html_tmpl, text_tmpl)
 
-    suppressions = set()
+    build = partial(
+        build_message,
+        subject_tmpl=compile_template(subject_tmpl),
+        html_tmpl=compile_template(html_tmpl),
+        text_tmpl=compile_template(text_tmpl),
+        attachment=_ATTACHMENT,
+    )
+    # used when prebuilt bytes can't be sent as-is (no 8BITMIME/SMTPUTF8,
+    # or a substituted line is too long for an 8bit body)
+    fallback = partial(build, msg_policy=_SEVEN_BIT)
+
+    fast = FAST_SERIALIZE
+    if fast and not fits_8bit(html_tmpl, text_tmpl):
+        logging.warning(
+            "FAST_SERIALIZE ignored: template lines longer than "
+            f"{MAX_LINE_OCTETS} bytes need QP/base64 encoding."
+        )
+        fast = False
+
+    if fast:
+        # 8bit keeps the ${...} markers byte-for-byte in the serialized body
+        render = partial(
+            render_fast,
+            base=build_base_bytes(
+                text_tmpl.template, html_tmpl.template, _ATTACHMENT, cte="8bit"
+            ),
+            subject_tmpl=compile_template(subject_tmpl),
+            personalize=True,
+            fallback=fallback,
+        )
+    elif is_static(html_tmpl) and is_static(text_tmpl):
+        # identical body for everyone: serialize it once, vary only headers
+        render = partial(
+            render_fast,
+            base=build_base_bytes(
+                compile_template(text_tmpl)({}),
+                compile_template(html_tmpl)({}),
+                _ATTACHMENT,
+            ),
+            subject_tmpl=compile_template(subject_tmpl),
+            personalize=False,
+        )
+    else:
+        render = build
+
+    suppressions = frozenset()
     if os.path.exists(SUPPRESSIONS_FILE):
         with open(SUPPRESSIONS_FILE, encoding="utf-8") as f:
-            suppressions = {l.strip().lower() for l in f if l.strip()}
+            suppressions = frozenset(l.strip().lower() for l in f if l.strip())
 
-    # rate limit: pause between emails
-    pause_seconds = 60.0 / RATE_LIMIT_PER_MIN
-    required_cols = {"email"} | (used_keys & {"name", "company"})
+    required_extra = used_keys & {"name", "company"}
+    required_cols = {"email"} | required_extra
     if not csv_preflight(RECIPIENTS_CSV, required=tuple(sorted(required_cols))):
         return
 
-    rows = list(load_recipients(RECIPIENTS_CSV))
-    total = len(rows)
-    logging.info(f"Loaded {total} recipients.")
+    total = count_rows(RECIPIENTS_CSV)
+    logging.info(f"Found ~{total} rows.")
     if total == 0:
         logging.warning("No recipients found. Aborting.")
         return
@@ -375,86 +1027,107 @@ def main():
     sent = 0
     failed = 0
     invalid_total = 0
+    send_errors = 0
     skipped = 0
+    incomplete = False
+
+    outbox = queue.Queue(maxsize=2 * CONCURRENCY)
+    results = queue.Queue()
+    stop = threading.Event()
+    producer = threading.Thread(
+        target=_produce,
+        args=(
+            load_recipients(RECIPIENTS_CSV),
+            total,
+            render,
+            required_extra,
+            suppressions,
+            outbox,
+            results,
+            stop,
+        ),
+        name="producer",
+        daemon=True,
+    )
+    prefetcher = threading.Thread(
+        target=prefetch_mx,
+        args=(
+            (
+                email
+                for email in (
+                    (row.get("email") or "").strip()
+                    for row in load_recipients(RECIPIENTS_CSV)
+                )
+                if email.lower() not in suppressions
+            ),
+            stop,
+        ),
+        name="prefetch-mx",
+        daemon=True,
+    )
 
-    with smtp_client() as smtp:
-        for i, row in enumerate(rows, start=1):
-            email = (row.get("email") or "").strip()
-            normalized = normalize_email(email)
-            if not normalized:
-                logging.warning(f"[{i}/{total}] Invalid email: {email}. Skipping.")
-                failed += 1
-                invalid_total += 1
-                continue
-
-            row["email"] = normalized
-
-            if normalized.lower() in suppressions:
-                logging.info(f"[{i}/{total}] Suppressed: {email}. Skipping.")
-                skipped += 1
-                continue
-
-            ok, reason = ensure_required_fields(row, used_keys, i, total)
-            if not ok:
-                logging.warning(reason)
-                failed += 1
-                continue
-
-            msg = build_message(row, subject_tmpl, html_tmpl, text_tmpl)
-
-            # retry with backoff
-            for attempt in range(1, MAX_RETRIES + 1):
-                try:
-                    if DRY_RUN:
-                        logging.info(
-                            f"[{i}/{total}] DRY-RUN to {email} (skipped sending)"
-                        )
+    try:
+        with ThreadPoolExecutor(
+            max_workers=CONCURRENCY, initializer=_init_worker
+        ) as pool:
+            workers = [
+                pool.submit(_consume, total, fallback, outbox, results, stop)
+                for _ in range(CONCURRENCY)
+            ]
+            prefetcher.start()
+            producer.start()
+
+            # every worker and the producer report None when they finish
+            running = CONCURRENCY + 1
+            try:
+                while running:
+                    status = results.get()
+                    if status is None:
+                        running -= 1
+                        continue
+                    if status == "sent":
+                        sent += 1
+                    elif status == "skipped":
                         skipped += 1
-                        break
-
-                    smtp.send_message(msg)
-                    sent += 1
-                    logging.info(f"[{i}/{total}] Sent to {email}")
-                    break
-
-                except smtplib.SMTPServerDisconnected as e:
-                    logging.warning(
-                        f"[{i}/{total}] SMTP disconnected for {email}: {e}. Reconnecting…"
-                    )
-                    try:
-                        smtp = smtp_client()
+                    elif status == "invalid":
+                        failed += 1
+                        invalid_total += 1
+                    elif status == "error":
+                        failed += 1
+                        send_errors += 1
+                    elif status == "cancelled":
                         continue
-                    except Exception as e2:
-                        logging.error(f"Reconnect failed: {e2}")
-                        is_temp = True
-
-                except smtplib.SMTPResponseException as e:
-                    code = e.smtp_code
-                    err = (
-                        e.smtp_error.decode()
-                        if isinstance(e.smtp_error, bytes)
-                        else str(e.smtp_error)
-                    )
-                    logging.error(f"[{i}/{total}] SMTP {code} to {email}: {err}")
-                    is_temp = 400 <= code < 500
-
-                except Exception as e:
-                    logging.error(f"[{i}/{total}] Error to {email}: {e}")
-                    is_temp = True
-
-                if attempt < MAX_RETRIES and is_temp:
-                    sleep_time = min(
-                        60, (2 ** (attempt - 1)) + random.uniform(0, JITTER)
-                    )
-                    time.sleep(sleep_time)
-                else:
-                    failed += 1
-                    break
-
-            # rate-limit between receivers
-            if i < total:
-                time.sleep(pause_seconds + random.uniform(0, JITTER))
-
+                    elif status == "aborted":
+                        incomplete = True
+                        continue
+                    else:
+                        failed += 1
+
+                    attempted = sent + send_errors
+                    if (
+                        not stop.is_set()
+                        and attempted >= FAIL_MIN_BATCH
+                        and send_errors >= attempted * FAIL_RATIO
+                    ):
+                        logging.error(
+                            f"Abort: failure ratio too high ({send_errors}/{attempted} sends failed)."
+                        )
+                        stop.set()
+            except BaseException:
+                # Ctrl-C/crash: stop the producer, workers drain without sending
+                stop.set()
+                raise
+
+            producer.join()
+            for w in workers:
+                w.result()
+    finally:
+        stop.set()  # ends the prefetcher if it is still reading
+        _dns_pool.shutdown(wait=False, cancel_futures=True)
+        close_smtp_sessions()
+
+    if incomplete:
+        logging.error("Incomplete run: the recipients file could not be read to the end.")
     logging.info(
         f"Done. Sent: {sent} | Failed: {failed} | Skipped(dry-run): {skipped} | Log: {log_name}"
     )